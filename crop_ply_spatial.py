@@ -5,9 +5,18 @@ This removes background/irrelevant points by defining spatial boundaries for the
 """
 
 import numpy as np
-import struct
 import os
+import tempfile
 import argparse
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; fall back to NumPy masks
+    njit = None
 
 def read_ply_header(filepath):
     """Read PLY header to understand format and vertex count."""
@@ -23,84 +32,154 @@ def read_ply_header(filepath):
         return header_lines, f.tell()
 
 def parse_ply_header(header_lines):
-    """Parse PLY header to extract vertex count and properties."""
+    """Parse PLY header to extract vertex count and vertex properties."""
     vertex_count = 0
     properties = []
     format_type = None
+    element = None
     
     for line in header_lines:
         if line.startswith('format'):
             format_type = line.split()[1]
-        elif line.startswith('element vertex'):
-            vertex_count = int(line.split()[2])
-        elif line.startswith('property'):
+        elif line.startswith('element'):
+            parts = line.split()
+            element = parts[1]
+            if element == 'vertex':
+                vertex_count = int(parts[2])
+        elif line.startswith('property') and element == 'vertex':
             parts = line.split()
             prop_type = parts[1]
-            prop_name = parts[2]
+            prop_name = parts[-1]
             properties.append((prop_type, prop_name))
     
     return vertex_count, properties, format_type
 
-def create_struct_format(properties):
-    """Create struct format string from properties."""
-    format_str = '<'  # little endian
+PLY_DTYPES = {
+    'char': 'i1',
+    'uchar': 'u1',
+    'short': '<i2',
+    'ushort': '<u2',
+    'int': '<i4',
+    'uint': '<u4',
+    'float': '<f4',
+    'double': '<f8',
+    # Sized aliases from the PLY spec
+    'int8': 'i1',
+    'uint8': 'u1',
+    'int16': '<i2',
+    'uint16': '<u2',
+    'int32': '<i4',
+    'uint32': '<u4',
+    'float32': '<f4',
+    'float64': '<f8',
+}
+
+def create_vertex_dtype(properties):
+    """Create NumPy structured dtype matching the binary vertex layout."""
+    return _cached_vertex_dtype(tuple(properties))
+
+@lru_cache(maxsize=None)
+def _cached_vertex_dtype(properties):
     for prop_type, prop_name in properties:
-        if prop_type == 'float':
-            format_str += 'f'
-        elif prop_type == 'uchar':
-            format_str += 'B'
-        elif prop_type == 'int':
-            format_str += 'i'
-        elif prop_type == 'double':
-            format_str += 'd'
-    return format_str
+        if prop_type not in PLY_DTYPES:
+            raise ValueError(f"Unsupported PLY vertex property type '{prop_type}' for '{prop_name}'")
+    return np.dtype([(prop_name, PLY_DTYPES[prop_type]) for prop_type, prop_name in properties])
 
-def analyze_point_cloud_bounds(filepath, sample_size=10000):
-    """Analyze point cloud to understand spatial bounds."""
-    print(f"Analyzing spatial bounds of {filepath}...")
-    
-    header_lines, data_offset = read_ply_header(filepath)
-    vertex_count, properties, format_type = parse_ply_header(header_lines)
-    format_str = create_struct_format(properties)
-    vertex_size = struct.calcsize(format_str)
-    
-    # Read sample of vertices
-    actual_sample_size = min(sample_size, vertex_count)
-    vertices = []
-    
-    with open(filepath, 'rb') as f:
-        f.seek(data_offset)
+MAX_CHUNK_SIZE = 1000000  # Caps each chunk's bool mask at ~1 MB, so it stays cache-friendly
+
+@dataclass
+class PlyFile:
+    """Parsed PLY header, shared by the analysis and cropping passes."""
+    path: str
+    header_lines: list
+    data_offset: int
+    vertex_count: int
+    properties: list
+    format_type: str
+    vertex_dtype: np.dtype
+    
+    @classmethod
+    def from_path(cls, filepath):
+        """Read and parse the header of a PLY file once."""
+        header_lines, data_offset = read_ply_header(filepath)
+        vertex_count, properties, format_type = parse_ply_header(header_lines)
+        vertex_dtype = create_vertex_dtype(properties)
         
-        # Read evenly spaced samples
-        step = max(1, vertex_count // actual_sample_size)
+        # A truncated file only maps the vertices that are fully present
+        available = (os.path.getsize(filepath) - data_offset) // vertex_dtype.itemsize
+        if available < vertex_count:
+            print(f"Warning: {filepath} is truncated; header declares {vertex_count} vertices "
+                  f"but only {available} are present")
+            vertex_count = available
         
-        for i in range(0, vertex_count, step):
-            if len(vertices) >= actual_sample_size:
-                break
-                
-            f.seek(data_offset + i * vertex_size)
-            vertex_data = f.read(vertex_size)
-            if len(vertex_data) != vertex_size:
-                break
-            vertex = struct.unpack(format_str, vertex_data)
-            vertices.append(vertex)
-    
-    vertices = np.array(vertices)
+        return cls(filepath, header_lines, data_offset, vertex_count,
+                   properties, format_type, vertex_dtype)
+    
+    @cached_property
+    def vertices(self):
+        """Read-only memory map of the vertex block."""
+        return np.memmap(self.path, dtype=self.vertex_dtype, mode='r',
+                         offset=self.data_offset, shape=(self.vertex_count,))
+
+def get_worker_count():
+    """Number of threads used to filter chunks."""
+    # Numba's kernel is already parallel and is launched from the main thread;
+    # otherwise filter chunks on threads (NumPy releases the GIL in comparisons)
+    return 1 if njit is not None else (os.cpu_count() or 1)
+
+def map_in_order(func, items, n_workers):
+    """Like map(), but runs at most n_workers calls ahead on a thread pool."""
+    if n_workers <= 1:
+        yield from map(func, items)
+        return
+    
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def get_chunk_size(vertex_count):
+    """Chunk size giving one contiguous range per worker, capped to bound mask temporaries."""
+    return max(1, min(MAX_CHUNK_SIZE, -(-vertex_count // get_worker_count())))
+
+def compute_chunk_bounds(vertices, chunk_size):
+    """Compute per-chunk XYZ bounding boxes as an (n_chunks, 2, 3) array of [min, max]."""
+    starts = range(0, len(vertices), chunk_size)
+    chunk_bounds = np.empty((len(starts), 2, 3), dtype=vertices.dtype['x'])
+    
+    # One streaming pass: reduce all three axes while each chunk is resident
+    for i, chunk_start in enumerate(starts):
+        chunk_array = vertices[chunk_start:chunk_start + chunk_size]
+        for axis, name in enumerate('xyz'):
+            chunk_bounds[i, 0, axis] = chunk_array[name].min()
+            chunk_bounds[i, 1, axis] = chunk_array[name].max()
+    return chunk_bounds
+
+def analyze_point_cloud_bounds(ply):
+    """Analyze point cloud to understand spatial bounds."""
+    print(f"Analyzing spatial bounds of {ply.path}...")
     
-    if len(vertices) == 0:
+    vertex_count = ply.vertex_count
+    if vertex_count == 0:
         print("Error: No vertices read")
         return None
     
-    # Extract XYZ coordinates (first 3 columns)
-    xyz = vertices[:, :3]
+    # Index chunk bounding boxes so cropping can skip chunks outside the box;
+    # the exact cloud bounds follow from them in the same streaming pass
+    chunk_size = get_chunk_size(vertex_count)
+    chunk_bounds = compute_chunk_bounds(ply.vertices, chunk_size)
     
     # Calculate bounds
-    min_bounds = np.min(xyz, axis=0)
-    max_bounds = np.max(xyz, axis=0)
+    min_bounds = chunk_bounds[:, 0].min(axis=0)
+    max_bounds = chunk_bounds[:, 1].max(axis=0)
     center = (min_bounds + max_bounds) / 2
     ranges = max_bounds - min_bounds
     
-    print(f"\nSpatial Analysis (from {len(vertices)} sample points):")
+    print(f"\nSpatial Analysis (from all {vertex_count} points):")
     print(f"X range: [{min_bounds[0]:.3f}, {max_bounds[0]:.3f}] (range: {ranges[0]:.3f})")
     print(f"Y range: [{min_bounds[1]:.3f}, {max_bounds[1]:.3f}] (range: {ranges[1]:.3f})")
     print(f"Z range: [{min_bounds[2]:.3f}, {max_bounds[2]:.3f}] (range: {ranges[2]:.3f})")
@@ -112,16 +191,53 @@ def analyze_point_cloud_bounds(filepath, sample_size=10000):
         'center': center,
         'ranges': ranges,
         'vertex_count': vertex_count,
-        'properties': properties
+        'properties': ply.properties,
+        'chunk_size': chunk_size,
+        'chunk_bounds': chunk_bounds
     }
 
-def crop_by_bounds(input_path, output_path, x_range=None, y_range=None, z_range=None, 
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _bounds_mask_numba(x, y, z, x0, x1, y0, y1, z0, z1):
+        """Fused parallel bounds test over per-axis coordinate arrays."""
+        mask = np.empty(x.size, np.bool_)
+        for i in prange(x.size):
+            mask[i] = ((x[i] >= x0) & (x[i] <= x1) &
+                       (y[i] >= y0) & (y[i] <= y1) &
+                       (z[i] >= z0) & (z[i] <= z1))
+        return mask
+
+def compute_bounds_mask(vertices, x_range, y_range, z_range):
+    """Compute mask of vertices inside the bounds (Numba if available, else NumPy)."""
+    x, y, z = vertices['x'], vertices['y'], vertices['z']
+    
+    if njit is not None:
+        return _bounds_mask_numba(x, y, z, x_range[0], x_range[1],
+                                  y_range[0], y_range[1], z_range[0], z_range[1])
+    
+    mask = np.greater_equal(x, x_range[0])
+    tmp = np.empty_like(mask)
+    np.logical_and(mask, np.less_equal(x, x_range[1], out=tmp), out=mask)
+    np.logical_and(mask, np.greater_equal(y, y_range[0], out=tmp), out=mask)
+    np.logical_and(mask, np.less_equal(y, y_range[1], out=tmp), out=mask)
+    np.logical_and(mask, np.greater_equal(z, z_range[0], out=tmp), out=mask)
+    np.logical_and(mask, np.less_equal(z, z_range[1], out=tmp), out=mask)
+    return mask
+
+def crop_by_bounds(ply, output_path, x_range=None, y_range=None, z_range=None, 
                    center_crop_ratio=None, interactive=False):
     """Crop PLY file by removing points outside specified coordinate ranges."""
     
-    # First analyze the point cloud
-    bounds_info = analyze_point_cloud_bounds(input_path)
-    if bounds_info is None:
+    # Analyze the point cloud only when the cropping bounds depend on it
+    needs_analysis = (center_crop_ratio is not None or interactive or
+                      any(r is None for r in (x_range, y_range, z_range)))
+    bounds_info = None
+    if needs_analysis:
+        bounds_info = analyze_point_cloud_bounds(ply)
+        if bounds_info is None:
+            return False
+    elif ply.vertex_count == 0:
+        print("Error: No vertices read")
         return False
     
     # Determine cropping bounds
@@ -154,7 +270,7 @@ def crop_by_bounds(input_path, output_path, x_range=None, y_range=None, z_range=
         
         # For now, use suggested ranges (in real interactive mode, would prompt user)
         print("Using suggested ranges...")
-    else:
+    elif bounds_info is not None:
         # Use provided ranges or default to no cropping
         min_b, max_b = bounds_info['min_bounds'], bounds_info['max_bounds']
         x_range = x_range or [min_b[0], max_b[0]]
@@ -166,116 +282,114 @@ def crop_by_bounds(input_path, output_path, x_range=None, y_range=None, z_range=
     print(f"Y: [{y_range[0]:.3f}, {y_range[1]:.3f}]")
     print(f"Z: [{z_range[0]:.3f}, {z_range[1]:.3f}]")
     
-    # Read and process full point cloud
-    header_lines, data_offset = read_ply_header(input_path)
-    vertex_count, properties, format_type = parse_ply_header(header_lines)
-    format_str = create_struct_format(properties)
-    vertex_size = struct.calcsize(format_str)
+    # Compare in the coordinates' own precision (float32 for most PLYs); integer
+    # coordinates keep float64 bounds so fractional limits aren't truncated
+    coord_dtype = ply.vertex_dtype['x']
+    if not np.issubdtype(coord_dtype, np.floating):
+        coord_dtype = np.dtype(np.float64)
+    x_range, y_range, z_range = (np.asarray(r, dtype=coord_dtype) for r in (x_range, y_range, z_range))
     
-    cropped_vertices = []
-    chunk_size = 50000  # Process in chunks to handle memory
+    # Process full point cloud
+    vertex_count = ply.vertex_count
+    properties = ply.properties
     
-    print(f"\nProcessing {vertex_count} vertices in chunks...")
+    kept_count = 0
     
-    with open(input_path, 'rb') as f:
-        f.seek(data_offset)
+    n_workers = get_worker_count()
+    if bounds_info is not None:
+        chunk_size = bounds_info['chunk_size']
+        chunk_starts = range(0, vertex_count, chunk_size)
         
-        for chunk_start in range(0, vertex_count, chunk_size):
-            chunk_end = min(chunk_start + chunk_size, vertex_count)
-            chunk_count = chunk_end - chunk_start
-            
-            chunk_vertices = []
-            for i in range(chunk_count):
-                vertex_data = f.read(vertex_size)
-                if len(vertex_data) != vertex_size:
-                    break
-                vertex = struct.unpack(format_str, vertex_data)
-                chunk_vertices.append(vertex)
-            
-            if not chunk_vertices:
-                break
-            
-            chunk_array = np.array(chunk_vertices)
-            
-            # Apply spatial filtering (XYZ are first 3 columns)
-            xyz = chunk_array[:, :3]
-            
-            mask = ((xyz[:, 0] >= x_range[0]) & (xyz[:, 0] <= x_range[1]) &
-                   (xyz[:, 1] >= y_range[0]) & (xyz[:, 1] <= y_range[1]) &
-                   (xyz[:, 2] >= z_range[0]) & (xyz[:, 2] <= z_range[1]))
-            
-            filtered_chunk = chunk_array[mask]
+        # Classify chunks by bounding box: skip disjoint ones, keep contained ones whole
+        box_min = np.array([x_range[0], y_range[0], z_range[0]], dtype=coord_dtype)
+        box_max = np.array([x_range[1], y_range[1], z_range[1]], dtype=coord_dtype)
+        chunk_min, chunk_max = bounds_info['chunk_bounds'][:, 0], bounds_info['chunk_bounds'][:, 1]
+        outside = np.any((chunk_min > box_max) | (chunk_max < box_min), axis=1)
+        inside = np.all((chunk_min >= box_min) & (chunk_max <= box_max), axis=1)
+    else:
+        # No chunk index without the analysis pass; mask every chunk
+        chunk_size = get_chunk_size(vertex_count)
+        chunk_starts = range(0, vertex_count, chunk_size)
+        outside = inside = np.zeros(len(chunk_starts), dtype=bool)
+    
+    print(f"\nProcessing {vertex_count} vertices in chunks "
+          f"({np.count_nonzero(outside)}/{len(chunk_starts)} chunks outside bounds skipped)...")
+    
+    # Chunks are sliced from the mapped vertex block, straight from the page cache
+    vertices = ply.vertices
+    
+    def filter_range(chunk_index):
+        chunk_start = chunk_starts[chunk_index]
+        chunk_array = vertices[chunk_start:chunk_start + chunk_size]
+        if outside[chunk_index]:
+            return chunk_array[:0]
+        if inside[chunk_index]:
+            return np.array(chunk_array)
+        mask = compute_bounds_mask(chunk_array, x_range, y_range, z_range)
+        return chunk_array[mask]
+    
+    def output_header(kept_count):
+        # Pad the count to the input's width so the final header fits in place
+        kept_field = f"{kept_count:<{len(str(vertex_count))}}"
+        return build_ply_header(kept_field, properties,
+                                comments=[f"Spatially cropped from {ply.path}",
+                                          f"X range: [{x_range[0]:.3f}, {x_range[1]:.3f}]",
+                                          f"Y range: [{y_range[0]:.3f}, {y_range[1]:.3f}]", 
+                                          f"Z range: [{z_range[0]:.3f}, {z_range[1]:.3f}]",
+                                          f"Original: {vertex_count}, Cropped: {kept_field}"])
+    
+    # Stream kept chunks into a temp file next to the output, then patch the
+    # vertex count; the output is only replaced once the crop succeeded
+    fd, tmp_path = tempfile.mkstemp(suffix='.ply.tmp',
+                                    dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(output_header(0))
             
-            if len(filtered_chunk) > 0:
-                cropped_vertices.extend(filtered_chunk.tolist())
+            # Results arrive in submission order, preserving point order
+            results = map_in_order(filter_range, range(len(chunk_starts)), n_workers)
+            for chunk_start, filtered_chunk in zip(chunk_starts, results):
+                if len(filtered_chunk) > 0:
+                    filtered_chunk.tofile(out)
+                    kept_count += len(filtered_chunk)
+                
+                progress = min(chunk_start + chunk_size, vertex_count)
+                print(f"Processed {progress}/{vertex_count} vertices ({progress/vertex_count*100:.1f}%) - "
+                      f"kept {kept_count} so far")
             
-            progress = min(chunk_end, vertex_count)
-            print(f"Processed {progress}/{vertex_count} vertices ({progress/vertex_count*100:.1f}%) - "
-                  f"kept {len(cropped_vertices)} so far")
-    
-    if not cropped_vertices:
-        print("Error: No vertices remain after cropping!")
-        return False
-    
-    cropped_vertices = np.array(cropped_vertices)
+            out.seek(0)
+            out.write(output_header(kept_count))
+        
+        if kept_count == 0:
+            print("Error: No vertices remain after cropping!")
+            return False
+        
+        # mkstemp creates the file as 0600; give it the usual umask-based mode
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     
     print(f"\nCropping results:")
     print(f"Original vertices: {vertex_count}")
-    print(f"Cropped vertices: {len(cropped_vertices)}")
-    print(f"Reduction: {(1 - len(cropped_vertices)/vertex_count)*100:.1f}%")
-    print(f"Kept: {len(cropped_vertices)/vertex_count*100:.1f}%")
-    
-    # Write output PLY file
-    write_ply_file(output_path, cropped_vertices, properties, 
-                   comments=[f"Spatially cropped from {input_path}",
-                            f"X range: [{x_range[0]:.3f}, {x_range[1]:.3f}]",
-                            f"Y range: [{y_range[0]:.3f}, {y_range[1]:.3f}]", 
-                            f"Z range: [{z_range[0]:.3f}, {z_range[1]:.3f}]",
-                            f"Original: {vertex_count}, Cropped: {len(cropped_vertices)}"])
+    print(f"Cropped vertices: {kept_count}")
+    print(f"Reduction: {(1 - kept_count/vertex_count)*100:.1f}%")
+    print(f"Kept: {kept_count/vertex_count*100:.1f}%")
     
     print(f"\nOutput saved to: {output_path}")
     return True
 
-def write_ply_file(output_path, vertices, properties, comments=None):
-    """Write vertices to a PLY file."""
-    vertex_count = len(vertices)
-    
-    with open(output_path, 'wb') as f:
-        # Write header
-        f.write(b'ply\n')
-        f.write(b'format binary_little_endian 1.0\n')
-        
-        if comments:
-            for comment in comments:
-                f.write(f'comment {comment}\n'.encode('ascii'))
-        
-        f.write(f'element vertex {vertex_count}\n'.encode('ascii'))
-        
-        for prop_type, prop_name in properties:
-            f.write(f'property {prop_type} {prop_name}\n'.encode('ascii'))
-        
-        f.write(b'end_header\n')
-        
-        # Write vertex data
-        format_str = create_struct_format(properties)
-        
-        for vertex in vertices:
-            # Convert vertex data to proper types
-            converted_vertex = []
-            for i, (prop_type, prop_name) in enumerate(properties):
-                if prop_type == 'float':
-                    converted_vertex.append(float(vertex[i]))
-                elif prop_type == 'uchar':
-                    converted_vertex.append(int(vertex[i]) % 256)  # Ensure 0-255 range
-                elif prop_type == 'int':
-                    converted_vertex.append(int(vertex[i]))
-                elif prop_type == 'double':
-                    converted_vertex.append(float(vertex[i]))
-                else:
-                    converted_vertex.append(vertex[i])
-            
-            vertex_data = struct.pack(format_str, *converted_vertex)
-            f.write(vertex_data)
+def build_ply_header(vertex_count, properties, comments=None):
+    """Build a binary little-endian PLY header as bytes."""
+    lines = ['ply', 'format binary_little_endian 1.0']
+    lines += [f'comment {comment}' for comment in comments or []]
+    lines.append(f'element vertex {vertex_count}')
+    lines += [f'property {prop_type} {prop_name}' for prop_type, prop_name in properties]
+    lines.append('end_header')
+    return ('\n'.join(lines) + '\n').encode('ascii')
 
 def main():
     """Main function with command line interface."""
@@ -301,8 +415,14 @@ def main():
         print(f"Error: Input file {args.input} does not exist")
         return 1
     
+    try:
+        ply = PlyFile.from_path(args.input)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return 1
+    
     if args.analyze_only:
-        analyze_point_cloud_bounds(args.input)
+        analyze_point_cloud_bounds(ply)
         return 0
     
     # Prepare ranges
@@ -328,7 +448,7 @@ def main():
             return 1
         z_range = [args.z_min, args.z_max]
     
-    success = crop_by_bounds(args.input, args.output, 
+    success = crop_by_bounds(ply, args.output, 
                            x_range=x_range, y_range=y_range, z_range=z_range,
                            center_crop_ratio=args.center_crop,
                            interactive=args.interactive)
@@ -3,8 +3,9 @@
 """
 Gera um vídeo MP4 orbitando uma nuvem de pontos (.ply) em modo headless (sem CUDA/OpenGL).
 - Lê o PLY via Open3D (apenas I/O)
-- Renderiza com Matplotlib 3D (backend Agg)
-- Grava com FFMpegWriter (libx264)
+- Projeta os pontos em 2D por frame (NumPy) e desenha com Matplotlib (backend Agg),
+  ou, com --renderer open3d, rasteriza com o OffscreenRenderer do Open3D (EGL/GPU)
+- Envia os frames RGBA crus para o ffmpeg via stdin (sem PNG intermediário)
 
 Exemplo:
   python3 viz_video_matplotlib.py \
@@ -15,13 +16,21 @@ Exemplo:
 """
 
 import argparse
+import queue
+import subprocess
+import threading
 import numpy as np
 import matplotlib
 matplotlib.use("Agg")  # backend headless
 import matplotlib.pyplot as plt
-from matplotlib.animation import FFMpegWriter
+import matplotlib.colors as mcolors
 import open3d as o3d
 
+try:
+    from tqdm import tqdm
+except ImportError:  # tqdm é opcional; sem ele não há barra de progresso
+    tqdm = None
+
 STYLES = {
     "neon":    dict(bg="black", colormap="turbo",   point_size=3.5, elev=18, az0=-80,  az1=280, axes=0),
     "depth":   dict(bg="white", colormap="viridis", point_size=2.5, elev=15, az0=-60,  az1=300, axes=0),
@@ -34,13 +43,16 @@ def load_ply(path, max_points=50000):
     """Load and downsample point cloud for faster rendering"""
     pcd = o3d.io.read_point_cloud(path)
     pts = np.asarray(pcd.points)
-    cols = np.asarray(pcd.colors) if len(pcd.colors) == len(pcd.points) else None
+    cols = np.asarray(pcd.colors)
+    if len(cols) != len(pts):
+        cols = None
     
     print(f"Loaded {len(pts)} points from {path}")
     
     # Downsample if too many points
     if len(pts) > max_points:
-        indices = np.random.choice(len(pts), max_points, replace=False)
+        rng = np.random.default_rng()
+        indices = rng.choice(len(pts), size=max_points, replace=False, shuffle=False)
         pts = pts[indices]
         if cols is not None:
             cols = cols[indices]
@@ -48,13 +60,113 @@ def load_ply(path, max_points=50000):
     
     return pts, cols
 
-def set_equal_axes(ax, pts):
+def view_matrix(elev, azim):
+    """Rotation taking world XYZ to (screen x, screen y, depth) for an mplot3d-style view."""
+    el, az = np.deg2rad(elev), np.deg2rad(azim)
+    return np.array([
+        [-np.sin(az),              np.cos(az),              0.0],
+        [-np.sin(el) * np.cos(az), -np.sin(el) * np.sin(az), np.cos(el)],
+        [ np.cos(el) * np.cos(az),  np.cos(el) * np.sin(az), np.sin(el)],
+    ])
+
+def open_ffmpeg(out, width, height, fps, pix_fmt="rgba"):
+    """Start ffmpeg reading raw frames from stdin (mpeg4, 8000 kb/s)."""
+    cmd = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{width}x{height}", "-r", str(fps),
+        "-i", "-",
+        "-c:v", "mpeg4", "-b:v", "8000k", "-pix_fmt", "yuv420p",
+        out,
+    ]
+    return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+def write_frames(proc, frames_queue, errors):
+    """Consume frames from the queue and write them to ffmpeg's stdin until None arrives."""
+    while True:
+        frame = frames_queue.get()
+        if frame is None:
+            break
+        if not errors:
+            try:
+                proc.stdin.write(frame)
+            except OSError as e:  # ffmpeg saiu; continua drenando a fila
+                errors.append(e)
+
+def render_frames_matplotlib(args, pts, cols, azims):
+    """Yield RGBA frames drawn with a 2D Matplotlib scatter (CPU, headless)."""
+    # figura (smaller for faster rendering)
+    if args.bg == "black":
+        plt.style.use("dark_background")
+    fig = plt.figure(figsize=(8, 8), dpi=80)
+    ax = fig.add_subplot(111)
+    fig.patch.set_facecolor(args.bg)
+    ax.set_facecolor(args.bg)
+    if not args.axes:
+        ax.set_axis_off()
+
+    # centraliza a nuvem; o raio cobre qualquer rotação
+    mins = pts.min(0); maxs = pts.max(0)
+    pts_centered = pts - (mins + maxs) / 2.0
+    r = np.sqrt((pts_centered ** 2).sum(1).max())
+    ax.set_xlim(-r, r)
+    ax.set_ylim(-r, r)
+    ax.set_aspect("equal")
+
+    # cor: usa cor do PLY, senão colormap por profundidade (Z)
+    z = pts[:, 2]
+    offsets = np.zeros((len(pts), 2))
+    if cols is None:
+        sc = ax.scatter(offsets[:, 0], offsets[:, 1], c=z, cmap=args.colormap,
+                        vmin=z.min(), vmax=z.max(), s=args.point_size)
+    else:
+        sc = ax.scatter(offsets[:, 0], offsets[:, 1], c=cols, s=args.point_size)
+
+    for az in azims:
+        # projeta e desenha do mais distante para o mais próximo
+        proj = pts_centered @ view_matrix(args.elev, az).T
+        order = np.argsort(proj[:, 2])
+        sc.set_offsets(proj[order, :2])
+        if cols is None:
+            sc.set_array(z[order])
+        else:
+            sc.set_facecolors(cols[order])
+        fig.canvas.draw()
+        yield np.asarray(fig.canvas.buffer_rgba())
+
+def render_frames_open3d(args, pts, cols, azims, size=640, fov=30.0):
+    """Yield RGB frames rendered by Open3D's OffscreenRenderer (Filament, needs EGL/GPU)."""
+    rendering = o3d.visualization.rendering
+    renderer = rendering.OffscreenRenderer(size, size)
+    renderer.scene.set_background(list(mcolors.to_rgba(args.bg)))
+
+    # cor: usa cor do PLY, senão colormap por profundidade (Z)
+    if cols is None:
+        z = pts[:, 2]
+        cols = plt.get_cmap(args.colormap)(mcolors.Normalize(z.min(), z.max())(z))
+        cols = np.ascontiguousarray(cols[:, :3])
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(pts))
+    pcd.colors = o3d.utility.Vector3dVector(cols)
+
+    mat = rendering.MaterialRecord()
+    mat.shader = "defaultUnlit"
+    mat.point_size = args.point_size
+    renderer.scene.add_geometry("pcd", pcd, mat)
+
+    # câmera orbitando o centro, à distância que enquadra a esfera envolvente
     mins = pts.min(0); maxs = pts.max(0)
-    c = (mins + maxs) / 2.0
-    r = (maxs - mins).max() / 2.0
-    ax.set_xlim(c[0]-r, c[0]+r)
-    ax.set_ylim(c[1]-r, c[1]+r)
-    ax.set_zlim(c[2]-r, c[2]+r)
+    center = (mins + maxs) / 2.0
+    r = np.sqrt(((pts - center) ** 2).sum(1).max())
+    dist = r / np.sin(np.deg2rad(fov / 2.0))
+
+    for az in azims:
+        eye = center + dist * view_matrix(args.elev, az)[2]
+        renderer.setup_camera(fov, center, eye, [0.0, 0.0, 1.0])
+        yield np.asarray(renderer.render_to_image())
+
+RENDERERS = {
+    "matplotlib": render_frames_matplotlib,
+    "open3d":     render_frames_open3d,
+}
 
 def main():
     ap = argparse.ArgumentParser()
@@ -63,6 +175,8 @@ def main():
     ap.add_argument("--fps", type=int, default=30)
     ap.add_argument("--out", default="renders/out.mp4")
     ap.add_argument("--max-points", type=int, default=50000, help="Maximum points to render (downsample if more)")
+    ap.add_argument("--renderer", default="matplotlib", choices=list(RENDERERS.keys()),
+                    help="matplotlib (CPU, headless) ou open3d (OffscreenRenderer, requer EGL/GPU)")
 
     # estilo pré-definido ou custom
     ap.add_argument("--style", default="neon", choices=list(STYLES.keys())+["custom"])
@@ -91,45 +205,45 @@ def main():
     if pts.size == 0:
         raise RuntimeError("Point cloud vazio (ou arquivo não encontrado).")
 
-    # figura (smaller for faster rendering)
-    if args.bg == "black":
-        plt.style.use("dark_background")
-    fig = plt.figure(figsize=(8, 8), dpi=80)
-    ax = fig.add_subplot(111, projection="3d")
-    fig.patch.set_facecolor(args.bg)
-    ax.set_facecolor(args.bg)
-    if not args.axes:
-        ax.set_axis_off()
-
-    set_equal_axes(ax, pts)
-
-    # cor: usa cor do PLY, senão colormap por profundidade (Z)
-    if cols is None or len(cols) != len(pts):
-        z = pts[:, 2]
-        sc = ax.scatter(pts[:, 0], pts[:, 1], pts[:, 2],
-                        c=z, cmap=args.colormap, s=args.point_size)
-    else:
-        sc = ax.scatter(pts[:, 0], pts[:, 1], pts[:, 2],
-                        c=cols, s=args.point_size)
-
-    # writer (use mpeg4 codec which should be available)
     n_frames = max(1, args.seconds * args.fps)
-    writer = FFMpegWriter(
-        fps=args.fps,
-        codec="mpeg4",
-        bitrate=8000
-    )
-
-    with writer.saving(fig, args.out, dpi=80):
-        print(f"Generating {n_frames} frames...")
-        for i in range(n_frames):
-            if i % 10 == 0:
-                print(f"  Frame {i+1}/{n_frames}")
-            az = args.azim_start + (args.azim_end - args.azim_start) * (i / (n_frames - 1))
-            ax.view_init(elev=float(args.elev), azim=float(az))
-            writer.grab_frame()
+    azims = [args.azim_start + (args.azim_end - args.azim_start) * (i / (n_frames - 1))
+             for i in range(n_frames)]
+    frames = RENDERERS[args.renderer](args, pts, cols, azims)
+
+    # writer: frames crus via pipe (use mpeg4 codec which should be available);
+    # uma thread escreve no ffmpeg enquanto o próximo frame é renderizado
+    proc = None
+    frames_queue = queue.Queue(maxsize=2)
+    errors = []
+    print(f"Generating {n_frames} frames...")
+    if tqdm is not None:
+        frames = tqdm(frames, total=n_frames, unit="frame")
+    try:
+        for frame in frames:
+            if errors:  # ffmpeg saiu; não adianta renderizar o resto
+                break
+            if proc is None:
+                height, width, channels = frame.shape
+                proc = open_ffmpeg(args.out, width, height, args.fps,
+                                   "rgba" if channels == 4 else "rgb24")
+                writer = threading.Thread(target=write_frames, args=(proc, frames_queue, errors))
+                writer.start()
+            # copia: o buffer do canvas é reutilizado no próximo frame
+            frames_queue.put(frame.tobytes())
+    finally:
+        if proc is not None:
+            frames_queue.put(None)
+            writer.join()
+            try:
+                proc.stdin.close()
+            except OSError as e:  # pipe quebrado ao descarregar o buffer
+                errors.append(e)
+            proc.wait()
+    if proc.returncode != 0 or errors:
+        detail = f": {errors[0]}" if errors else ""
+        raise RuntimeError(f"ffmpeg falhou (código {proc.returncode}){detail}.")
 
     print(f"[OK] Vídeo salvo em: {args.out}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()